@@ -1,39 +1,181 @@
 # -*- coding: utf-8 -*-
 """
 角色（人设）相关的查询与 system prompt 组装
+- 角色数据极少变动：组装好的 system prompt 按 (character_id, character_name) 缓存在进程内，
+  带 TTL（PROMPT_CACHE_TTL_SECONDS），其它 worker 上的角色修改最迟一个 TTL 后生效
+- 全部角色在启动时载入进程内字典（CHARACTERS_BY_ID / CHARACTERS_BY_NAME），并定期 reload_characters() 刷新
+- 字典未命中（如其它 worker 新建的角色）再依次查 Redis（char:id:{id} / char:name:{name}）与 DB
+- 角色被修改后调用 invalidate_character() / invalidate_prompt_cache() 失效
 """
-from typing import Optional
-from sqlalchemy.orm import Session
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession
 from .models import CharacterInfo
+from .redis_cache import get_cached_character, set_cached_character, delete_cached_character
 
-def get_character_by_name(db: Session, name: str) -> Optional[CharacterInfo]:
-    return db.query(CharacterInfo).filter(CharacterInfo.name == name).first()
+DEFAULT_SYSTEM_PROMPT = "You are a helpful assistant."
 
-def get_character_by_id(db: Session, cid: int) -> Optional[CharacterInfo]:
-    return db.query(CharacterInfo).filter(CharacterInfo.id == cid).first()
+# 进程内 LRU：key = (character_id, character_name)，value = (过期时间, 组装好的 prompt)
+_PROMPT_CACHE_MAX = 512
+PROMPT_CACHE_TTL_SECONDS = float(os.getenv("PROMPT_CACHE_TTL_SECONDS", "300"))
+_prompt_cache: "OrderedDict[Tuple[Optional[int], Optional[str]], Tuple[float, str]]" = OrderedDict()
 
-def build_system_prompt(db: Session, character_name: Optional[str], character_id: Optional[int]) -> str:
-    """根据角色信息组装 system prompt"""
-    char: Optional[CharacterInfo] = None
+# 进程内角色表：启动时全量载入，reload 时整体替换；单个角色回填 / 失效由 _remember / _forget 原地增删。
+# 只在事件循环线程里访问，单键增删中间没有 await，读者（只做 .get）无需加锁
+CHARACTERS_BY_ID: Dict[int, Dict[str, Any]] = {}
+CHARACTERS_BY_NAME: Dict[str, Dict[str, Any]] = {}
+
+def _normalize_name(name: str) -> str:
+    return name.strip().lower()
+
+def character_to_dict(char: CharacterInfo) -> Dict[str, Any]:
+    """ORM 行 -> 可序列化 dict（缓存与接口返回共用）"""
+    return {
+        "id": char.id,
+        "name": char.name,
+        "background": char.background,
+        "personality": char.personality,
+        "skills": char.skills,
+        "current_playstyle": char.current_playstyle,
+    }
+
+# 只查角色字典需要的列：结果是轻量 Row，不构造 ORM 实体、不进 identity map
+_CHARACTER_COLUMNS = (
+    CharacterInfo.id,
+    CharacterInfo.name,
+    CharacterInfo.background,
+    CharacterInfo.personality,
+    CharacterInfo.skills,
+    CharacterInfo.current_playstyle,
+)
+
+async def list_character_dicts(db: AsyncSession) -> List[Dict[str, Any]]:
+    """按 id 升序返回全部角色（dict 形态，与 character_to_dict 字段一致）"""
+    q = select(*_CHARACTER_COLUMNS).order_by(CharacterInfo.id.asc())
+    return [dict(r) for r in (await db.execute(q)).mappings().all()]
+
+async def get_character_by_name(db: AsyncSession, name: str) -> Optional[CharacterInfo]:
+    """按名字查角色（忽略首尾空白与大小写）"""
+    q = select(CharacterInfo).where(func.lower(CharacterInfo.name) == _normalize_name(name)).limit(1)
+    return (await db.execute(q)).scalars().first()
+
+async def get_character_by_id(db: AsyncSession, cid: int) -> Optional[CharacterInfo]:
+    return await db.get(CharacterInfo, cid)
+
+async def reload_characters(db: AsyncSession) -> int:
+    """全量读取 character_info，整体替换进程内角色表；返回角色数"""
+    global CHARACTERS_BY_ID, CHARACTERS_BY_NAME
+    by_id = {c["id"]: c for c in await list_character_dicts(db)}
+    CHARACTERS_BY_ID = by_id
+    CHARACTERS_BY_NAME = {_normalize_name(c["name"]): c for c in by_id.values()}
+    invalidate_prompt_cache()
+    return len(by_id)
+
+def _remember(char: Dict[str, Any]) -> None:
+    CHARACTERS_BY_ID[char["id"]] = char
+    CHARACTERS_BY_NAME[_normalize_name(char["name"])] = char
+
+def _forget(cid: int) -> None:
+    char = CHARACTERS_BY_ID.pop(cid, None)
+    if char:
+        CHARACTERS_BY_NAME.pop(_normalize_name(char["name"]), None)
+
+async def get_character(
+    db: AsyncSession,
+    rds,
+    character_id: Optional[int] = None,
+    character_name: Optional[str] = None,
+) -> Optional[Dict[str, Any]]:
+    """按 id（优先）或名字取角色：进程内字典 -> Redis -> DB（逐级回填）"""
+    if character_id is None and not character_name:
+        return None
     if character_id is not None:
-        char = get_character_by_id(db, character_id)
-    elif character_name:
-        char = get_character_by_name(db, character_name)
+        char = CHARACTERS_BY_ID.get(character_id)
+    else:
+        char = CHARACTERS_BY_NAME.get(_normalize_name(character_name))
+    if char is not None:
+        return char
 
-    if not char:
-        # 没有角色也允许对话，给一个通用的 system 作为兜底
-        return "You are a helpful assistant."
+    char = await get_cached_character(rds, cid=character_id, name=character_name)
+    if char is None:
+        if character_id is not None:
+            row = await get_character_by_id(db, character_id)
+        else:
+            row = await get_character_by_name(db, character_name)
+        if not row:
+            return None
+        char = character_to_dict(row)
+        await set_cached_character(rds, char)
+    _remember(char)
+    return char
 
+def _assemble_prompt(
+    name: str,
+    background: Optional[str],
+    personality: Optional[str],
+    skills: Optional[str],
+    current_playstyle: Optional[str],
+) -> str:
+    """纯函数：由角色字段拼出 system prompt"""
     parts = []
-    parts.append(f"你的名字：{char.name}")
-    if char.background:
-        parts.append(f"背景：{char.background}")
-    if char.personality:
-        parts.append(f"性格：{char.personality}")
-    if char.skills:
-        parts.append(f"技能：{char.skills}")
-    if char.current_playstyle:
-        parts.append(f"当前对话风格：{char.current_playstyle}")
+    parts.append(f"你的名字：{name}")
+    if background:
+        parts.append(f"背景：{background}")
+    if personality:
+        parts.append(f"性格：{personality}")
+    if skills:
+        parts.append(f"技能：{skills}")
+    if current_playstyle:
+        parts.append(f"当前对话风格：{current_playstyle}")
     parts.append("请保持符合人设的语气进行多轮对话。")
 
     return "\n".join(parts)
+
+def invalidate_prompt_cache() -> None:
+    """角色新增/修改后调用：清空已缓存的 system prompt"""
+    _prompt_cache.clear()
+
+async def invalidate_character(db: AsyncSession, rds, cid: int) -> None:
+    """角色被修改后调用：清掉 Redis 中的角色行（新旧名字都清）以及进程内 prompt 缓存"""
+    names = set()
+    cached = await get_cached_character(rds, cid=cid)
+    if cached:
+        names.add(cached["name"])
+    char = await get_character_by_id(db, cid)
+    if char:
+        names.add(char.name)
+    await delete_cached_character(rds, cid, names)
+    _forget(cid)
+    invalidate_prompt_cache()
+
+async def build_system_prompt(
+    db: AsyncSession,
+    rds,
+    character_name: Optional[str],
+    character_id: Optional[int],
+) -> str:
+    """根据角色信息组装 system prompt（命中缓存时不访问 DB）"""
+    name_key = _normalize_name(character_name) if character_name else None
+    key = (character_id, None if character_id is not None else (name_key or None))
+    now = time.monotonic()
+    cached = _prompt_cache.get(key)
+    if cached is not None and cached[0] > now:
+        _prompt_cache.move_to_end(key)
+        return cached[1]
+
+    char = await get_character(db, rds, character_id, character_name)
+    if not char:
+        # 没有角色也允许对话，给一个通用的 system 作为兜底
+        prompt = DEFAULT_SYSTEM_PROMPT
+    else:
+        prompt = _assemble_prompt(char["name"], char["background"], char["personality"],
+                                  char["skills"], char["current_playstyle"])
+
+    _prompt_cache[key] = (now + PROMPT_CACHE_TTL_SECONDS, prompt)
+    _prompt_cache.move_to_end(key)
+    if len(_prompt_cache) > _PROMPT_CACHE_MAX:
+        _prompt_cache.popitem(last=False)
+    return prompt
@@ -2,104 +2,190 @@
 """
 数据库 CRUD：会话与历史
 """
+from datetime import datetime
 from typing import List, Dict, Optional
-from sqlalchemy import select, func
-from sqlalchemy.orm import Session
-
-from .models import ChatSession, ChatHistory
-
-def upsert_session(db: Session, session_id: str, character_id: Optional[int]):
-    """创建或更新会话的活跃时间"""
-    s = db.get(ChatSession, session_id)
-    if not s:
-        s = ChatSession(id=session_id, character_id=character_id)
-        db.add(s)
-    s.last_active_at = func.now()
-    return s
-
-def add_turn(
-    db: Session,
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import ChatHistory
+
+# ====== 预编译的 SQL 语句 ======
+# 模块加载时构造一次 text()，每次调用不必重新解析；语句文本固定，驱动侧的预编译缓存也能命中
+
+# 事务级 advisory lock：同一会话的写入在 Postgres 内存中串行化，提交/回滚时自动释放；
+# 不同会话 hash 到不同的锁，互不影响
+_SESSION_XACT_LOCK_SQL = text("SELECT pg_advisory_xact_lock(hashtext(:sid))")
+
+# 一轮问答一条语句写完：CTE 里 upsert 会话（创建或刷新 last_active_at），
+# 再按固定顺序插入 user / assistant 两条消息（外键引用的会话行由同一语句产生）
+_ADD_TURN_SQL = text("""
+  WITH s AS (
+      INSERT INTO chat_sessions (id, character_id)
+           VALUES (:sid, CAST(:cid AS integer))
+      ON CONFLICT (id) DO UPDATE SET last_active_at = NOW()
+      RETURNING id
+  )
+  INSERT INTO chat_history (session_id, character_id, role, message)
+  SELECT s.id, CAST(:cid AS integer), v.role, v.message
+    FROM s
+   CROSS JOIN (VALUES (1, 'user', CAST(:user_msg AS text)),
+                      (2, 'assistant', CAST(:assistant_msg AS text))) AS v(ord, role, message)
+ORDER BY v.ord
+""")
+
+# 角色名以 character_info 为准（chat_history 不再冗余存角色名）；
+# 关联不到时（旧会话未绑 character_id、或角色已删除）回落到该会话首条消息上的旧 character_name。
+# COALESCE 只在 ci.name 为空时才执行子查询，走 (session_id, created_at) 索引取一行；
+# migrations/005 回填 chat_sessions.character_id 后只剩少数会话会走到这里
+_LIST_SESSIONS_SQL = text("""
+  SELECT cs.id  AS session_id,
+         cs.character_id,
+         COALESCE(ci.name, (
+             SELECT NULLIF(h.character_name, '')
+               FROM chat_history h
+              WHERE h.session_id = cs.id
+           ORDER BY h.created_at, h.id
+              LIMIT 1
+         )) AS character_name,
+         cs.created_at,
+         cs.last_active_at,
+         cs.title
+    FROM chat_sessions cs
+LEFT JOIN character_info ci ON ci.id = cs.character_id
+ORDER BY cs.last_active_at DESC, cs.id ASC
+  LIMIT :limit
+""")
+
+# 绑定角色：会话行可能还没有（/chat 在响应后才由后台任务落库），与落库的 CTE 并发时
+# 由 ON CONFLICT 决出先后，不会出现先查不到、再插入撞主键
+_BIND_CHARACTER_SQL = text("""
+  INSERT INTO chat_sessions (id, character_id)
+       VALUES (:sid, :cid)
+  ON CONFLICT (id) DO UPDATE SET character_id = EXCLUDED.character_id
+""")
+
+_RENAME_SESSION_SQL = text("""
+  UPDATE chat_sessions
+     SET title = :title, last_active_at = NOW()
+   WHERE id = :sid
+RETURNING id AS session_id, title
+""")
+
+_DELETE_SESSION_SQL = text("DELETE FROM chat_sessions WHERE id = :sid RETURNING id")
+
+# 无游标时取最新的 N 条：倒序走索引取前 N 条，再在 Python 里翻转成升序
+_LIST_MESSAGES_SQL = text("""
+  SELECT id, role, message AS content, created_at
+    FROM chat_history
+   WHERE session_id = :sid
+ORDER BY created_at DESC, id DESC
+   LIMIT :limit
+""")
+
+# 游标是 (created_at, id) 复合键：同一轮的 user/assistant 同一事务写入、created_at 相同，
+# 只按 created_at 翻页时页边界落在两者之间会漏掉 assistant；id 打破平局。
+# 冗余的 created_at >= :after 让 (session_id, created_at) 索引直接定位范围起点
+_LIST_MESSAGES_AFTER_SQL = text("""
+  SELECT id, role, message AS content, created_at
+    FROM chat_history
+   WHERE session_id = :sid
+     AND created_at >= :after
+     AND (created_at, id) > (:after, :after_id)
+ORDER BY created_at ASC, id ASC
+   LIMIT :limit
+""")
+
+# chat_history.id 是 SERIAL（int4）：未传 after_id 时取上限，(after, 上限) 之后即 created_at > after
+_MAX_MESSAGE_ID = 2**31 - 1
+
+async def add_turn(
+    db: AsyncSession,
     *,
     session_id: str,
     character_id: Optional[int],
-    character_name: Optional[str],
     user_msg: str,
     assistant_msg: str,
 ):
-    """写入一轮问答两条记录，并更新会话活跃时间"""
-    upsert_session(db, session_id, character_id)
-    db.add_all([
-        ChatHistory(session_id=session_id, character_id=character_id,
-                    character_name=character_name or "", role="user", message=user_msg),
-        ChatHistory(session_id=session_id, character_id=character_id,
-                    character_name=character_name or "", role="assistant", message=assistant_msg),
-    ])
-    db.commit()
-
-def load_history_from_db(db: Session, session_id: str, limit: int = 100) -> List[Dict]:
-    """从 DB 读取最近若干条历史，升序返回"""
-    q = (
-        select(ChatHistory.role, ChatHistory.message)
-        .where(ChatHistory.session_id == session_id)
-        .order_by(ChatHistory.created_at.asc())
-        .limit(limit)
-    )
-    rows = db.execute(q).all()
-    return [{"role": r[0], "content": r[1]} for r in rows]
-
-def list_sessions(db: Session, limit: int = 200) -> List[Dict]:
+    """
+    写入一轮问答两条记录，并更新会话活跃时间（单事务、单次提交）：
+    - 会话 upsert（INSERT ... ON CONFLICT）与两条消息的插入合并为一条 CTE 语句，一次往返
+    - 不再写 character_name（可由 character_id 关联 character_info 得到），缩小热表行宽
+    - 先取会话级 advisory lock，同一会话并发写入时排队而不是在行锁上互相等待/死锁
+    """
+    await db.execute(_SESSION_XACT_LOCK_SQL, {"sid": session_id})
+    await db.execute(_ADD_TURN_SQL, {
+        "sid": session_id,
+        "cid": character_id,
+        "user_msg": user_msg,
+        "assistant_msg": assistant_msg,
+    })
+    await db.commit()
+
+async def load_history_from_db(
+    db: AsyncSession,
+    session_id: str,
+    tail: int = 6,
+) -> List[Dict]:
+    """
+    从 DB 读取最近 tail 条历史，升序返回（对话上下文通常只需要最后几条）
+    - 倒序走 (session_id, created_at) 复合索引取前 tail 条，再翻转；Postgres 无需排序整段历史
+    """
+    q = select(ChatHistory.role, ChatHistory.message).where(ChatHistory.session_id == session_id)
+    # 同一轮的 user/assistant 在同一事务写入，created_at 相同，用 id 保证先后
+    q = q.order_by(ChatHistory.created_at.desc(), ChatHistory.id.desc()).limit(tail)
+    rows = (await db.execute(q)).all()
+    return [{"role": r[0], "content": r[1]} for r in reversed(rows)]
+
+async def list_sessions(db: AsyncSession, limit: int = 200) -> List[Dict]:
     """
     返回会话列表（包含角色名、创建时间、最后活跃时间、标题）。
     当前默认按 last_active_at DESC 排序；如需“创建顺序”，把 ORDER BY 改为 cs.created_at ASC。
     """
-    sql = """
-      SELECT cs.id  AS session_id,
-             cs.character_id,
-             COALESCE(ci.name, MAX(ch.character_name)) AS character_name,
-             cs.created_at,
-             cs.last_active_at,
-             cs.title
-        FROM chat_sessions cs
-   LEFT JOIN character_info ci ON ci.id = cs.character_id
-   LEFT JOIN chat_history  ch ON ch.session_id = cs.id
-    GROUP BY cs.id, cs.character_id, ci.name, cs.created_at, cs.last_active_at, cs.title
-    ORDER BY cs.last_active_at DESC, cs.id ASC
-      LIMIT :limit;
-    """
-    rows = db.execute(sql, {"limit": limit}).fetchall()
+    rows = (await db.execute(_LIST_SESSIONS_SQL, {"limit": limit})).mappings().all()
     return [dict(r) for r in rows]
 
-def rename_session(db: Session, sid: str, title: str) -> Dict:
+async def bind_session_character(db: AsyncSession, sid: str, character_id: int) -> None:
+    """把会话绑定到角色（会话不存在时创建），单条 upsert"""
+    await db.execute(_BIND_CHARACTER_SQL, {"sid": sid, "cid": character_id})
+    await db.commit()
+
+async def rename_session(db: AsyncSession, sid: str, title: str) -> Dict:
     """重命名会话"""
-    sql = """
-      UPDATE chat_sessions
-         SET title = :title, last_active_at = NOW()
-       WHERE id = :sid
-   RETURNING id AS session_id, title
-    """
-    row = db.execute(sql, {"sid": sid, "title": title}).fetchone()
-    db.commit()
+    row = (await db.execute(_RENAME_SESSION_SQL, {"sid": sid, "title": title})).mappings().first()
+    await db.commit()
     if not row:
         raise ValueError("session not found")
     return dict(row)
 
-def delete_session(db: Session, sid: str) -> Dict:
+async def delete_session(db: AsyncSession, sid: str) -> Dict:
     """删除会话（chat_history 通过外键 ON DELETE CASCADE 自动清理）"""
-    exist = db.execute("SELECT id FROM chat_sessions WHERE id=:sid", {"sid": sid}).fetchone()
-    if not exist:
+    row = (await db.execute(_DELETE_SESSION_SQL, {"sid": sid})).first()
+    await db.commit()
+    if not row:
         return {"deleted": 0}
-    db.execute("DELETE FROM chat_sessions WHERE id=:sid", {"sid": sid})
-    db.commit()
     return {"deleted": 1, "session_id": sid}
 
-def list_messages(db: Session, session_id: str, limit: int = 500) -> List[Dict]:
-    """会话内消息（升序）"""
-    sql = """
-      SELECT role, message AS content, created_at
-        FROM chat_history
-       WHERE session_id = :sid
-    ORDER BY created_at ASC
-       LIMIT :limit;
+async def list_messages(
+    db: AsyncSession,
+    session_id: str,
+    limit: int = 500,
+    after: Optional[datetime] = None,
+    after_id: Optional[int] = None,
+) -> List[Dict]:
     """
-    rows = db.execute(sql, {"sid": session_id, "limit": limit}).fetchall()
-    return [dict(r) for r in rows]
+    会话内消息（升序）
+    - 不带游标：返回最新的 limit 条
+    - after + after_id：键集分页游标（上一页最后一条的 created_at 与 id），返回其后的 limit 条；
+      只传 after 时等同于跳过该时刻的全部消息（旧行为）
+    """
+    if after is None:
+        rows = (await db.execute(_LIST_MESSAGES_SQL, {"sid": session_id, "limit": limit})).mappings().all()
+        return [dict(r) for r in reversed(rows)]
+    params = {
+        "sid": session_id,
+        "after": after,
+        "after_id": _MAX_MESSAGE_ID if after_id is None else after_id,
+        "limit": limit,
+    }
+    result = await db.execute(_LIST_MESSAGES_AFTER_SQL, params)
+    return [dict(r) for r in result.mappings().all()]
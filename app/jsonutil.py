@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+JSON 编解码的统一入口（main / redis_cache / qiniu_llm 共用）
+- 基于 orjson（requirements.txt 中为必需依赖）：直接产出 UTF-8 bytes，中文无需 ensure_ascii，
+  datetime 原生输出 ISO 8601
+- dumps() 一律返回 bytes，loads() 接受 bytes / str
+- sse_data()：拼好一帧 SSE（data: <json>\n\n）
+"""
+from typing import Any
+
+import orjson
+
+_OPT = orjson.OPT_NON_STR_KEYS
+
+
+def dumps(obj: Any) -> bytes:
+    return orjson.dumps(obj, option=_OPT)
+
+
+loads = orjson.loads
+
+_SSE_DATA = b"data: "
+_SSE_END = b"\n\n"
+
+
+def sse_data(obj: Any) -> bytes:
+    """一帧 SSE：data: <json>\\n\\n"""
+    return _SSE_DATA + dumps(obj) + _SSE_END
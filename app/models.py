@@ -10,7 +10,7 @@ SQLAlchemy ORM 模型定义
 2) Base 请从 app.database 导入，避免循环依赖。
 """
 
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, func
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Index, func
 from sqlalchemy.orm import relationship
 from sqlalchemy.dialects.postgresql import TIMESTAMP
 
@@ -40,6 +40,10 @@ class CharacterInfo(Base):
         return f"<CharacterInfo id={self.id} name={self.name!r}>"
 
 
+# 名字大小写不敏感唯一（与按名查找的 strip + lower 规则一致），也供 lower(name) 查询走索引
+Index("character_info_lower_name_uidx", func.lower(CharacterInfo.name), unique=True)
+
+
 # =======================
 # 会话表：chat_sessions
 # =======================
@@ -59,12 +63,13 @@ class ChatSession(Base):
     created_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=func.now())
     last_active_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=func.now())
 
-    # 方便通过会话拿到消息（lazy=selectin 减少 N+1）
+    # 会话 -> 消息（lazy=raise：只取会话元数据时不会连带把整段历史查出来；
+    # 需要消息请显式 select(ChatHistory)...limit(...)，误访问会直接报错而不是悄悄多查）
     messages = relationship(
         "ChatHistory",
         primaryjoin="ChatSession.id==ChatHistory.session_id",
         backref="session",
-        lazy="selectin",
+        lazy="raise",
         cascade="all, delete-orphan",
         passive_deletes=True,  # 与 ON DELETE CASCADE 对齐
     )
@@ -78,6 +83,11 @@ class ChatSession(Base):
 # =======================
 class ChatHistory(Base):
     __tablename__ = "chat_history"
+    __table_args__ = (
+        # 会话内按时间取历史（load_history_from_db / list_messages），免排序；
+        # 以 session_id 为前缀，取代原先单列的 session_id 索引
+        Index("chat_history_sid_created_idx", "session_id", "created_at"),
+    )
 
     # id SERIAL PRIMARY KEY
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -87,11 +97,10 @@ class ChatHistory(Base):
         String(255),
         ForeignKey("chat_sessions.id", ondelete="CASCADE"),
         nullable=False,
-        index=True,
     )
 
-    # 角色名：varchar(255) NOT NULL（为兼容旧数据而保留）
-    character_name = Column(String(255), nullable=False)
+    # 角色名：varchar(255)，仅旧数据有值；新消息不再写入，角色名经 character_id 关联 character_info 获取
+    character_name = Column(String(255), nullable=True)
 
     # 文本内容：text NOT NULL
     message = Column(Text, nullable=False)
@@ -4,12 +4,16 @@
 七牛 OpenAI 兼容（/v1/chat/completions）
 - 非流式：一次性返回 choices[0].message.content
 - 流式：逐条解析 SSE 的 data 行，拼接 choices[0].delta.content
+- 所有请求共用一个模块级 httpx.AsyncClient（连接池 + HTTP/2），避免每次请求重新握手
 """
 import os
-import json
-from typing import AsyncGenerator, List, Dict, Optional
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncGenerator, List, Dict, Optional, Set
 
-import aiohttp
+import httpx
+
+from . import jsonutil
 
 # 环境变量
 QINIU_BASE = os.getenv("QINIU_OPENAI_BASE", "").rstrip("/")  # 例如 https://openai.qiniu.com/v1
@@ -19,22 +23,94 @@ DEFAULT_MODEL = os.getenv("LLM_MODEL", "gpt-4o-mini")  # 你也可以在 .env 
 # 可选：本地 mock 开关（没配上游时快速自测）
 MOCK_LLM = os.getenv("MOCK_LLM", "0") == "1"
 
+# 上游连接池：最大连接数 / 最多保留的 keep-alive 连接数 / 建连失败重试次数
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "64"))
+LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", "32"))
+LLM_CONNECT_RETRIES = int(os.getenv("LLM_CONNECT_RETRIES", "2"))
+# 空闲 keep-alive 连接保留多久（httpx 默认只有 5 秒，对话请求间隔稍长就要重新握手）
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60"))
+# 读超时需覆盖长回复的生成时间；建连超时单独收紧，上游不可达时尽快失败
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "300"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+# 同时在途的上游调用上限（流式调用在整个流期间占一个名额），超出的请求排队等待
+LLM_MAX_INFLIGHT = int(os.getenv("LLM_MAX_INFLIGHT", "32"))
+
 
 class LLMError(Exception):
     pass
 
 
+# 请求头在导入时构造一次，作为共享客户端的默认头；流式请求仅额外带上 Accept
+_HEADERS: Dict[str, str] = {"Content-Type": "application/json"}
+if QINIU_KEY:
+    _HEADERS["Authorization"] = f"Bearer {QINIU_KEY}"
+_SSE_HEADERS: Dict[str, str] = {"Accept": "text/event-stream"}
+
+
+# 模块级共享客户端：连接复用，TLS 握手只在建连时发生一次
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """返回共享的 httpx.AsyncClient（首次调用时创建，应用启动钩子里会预先创建）"""
+    global _client
+    if _client is None:
+        limits = httpx.Limits(
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_MAX_KEEPALIVE,
+            keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+        )
+        # transport 级 retries 只重试建连失败（ConnectError/ConnectTimeout），
+        # 不会重放已发出的 POST，对非幂等的对话请求是安全的
+        transport = httpx.AsyncHTTPTransport(http2=True, limits=limits, retries=LLM_CONNECT_RETRIES)
+        _client = httpx.AsyncClient(
+            transport=transport,
+            headers=_HEADERS,
+            timeout=httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+        )
+    return _client
+
+
+async def close_http_client() -> None:
+    """应用关闭时释放连接池"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+# 准入控制：同时在途的上游调用不超过 LLM_MAX_INFLIGHT，超出的排队等待
+_inflight_sem: Optional[asyncio.Semaphore] = None  # 首次使用时在运行中的事件循环里创建
+
+
+def _get_inflight_sem() -> asyncio.Semaphore:
+    global _inflight_sem
+    if _inflight_sem is None:
+        _inflight_sem = asyncio.Semaphore(max(1, LLM_MAX_INFLIGHT))
+    return _inflight_sem
+
+
+@asynccontextmanager
+async def _admit():
+    async with _get_inflight_sem():
+        yield
+
+
 def _endpoint() -> str:
     if not QINIU_BASE:
         raise LLMError("QINIU_OPENAI_BASE is empty – 请在 .env 里配置真实的 https://openai.qiniu.com/v1")
     return f"{QINIU_BASE}/chat/completions"
 
 
-def _headers() -> Dict[str, str]:
-    h = {"Content-Type": "application/json"}
-    if QINIU_KEY:
-        h["Authorization"] = f"Bearer {QINIU_KEY}"
-    return h
+async def list_model_ids() -> Set[str]:
+    """上游 /models 返回的模型 ID 集合（走共享客户端，复用已建立的连接）"""
+    if not QINIU_BASE:
+        raise LLMError("QINIU_OPENAI_BASE is empty")
+    resp = await get_http_client().get(f"{QINIU_BASE}/models")
+    if resp.status_code != 200:
+        raise LLMError(f"HTTP {resp.status_code}: {resp.text}")
+    data = jsonutil.loads(resp.content)
+    return {item["id"] for item in data.get("data", []) if "id" in item}
 
 
 async def chat_completion(messages: List[Dict[str, str]], model: Optional[str] = None) -> str:
@@ -49,16 +125,16 @@ async def chat_completion(messages: List[Dict[str, str]], model: Optional[str] =
         "stream": False,
     }
 
-    async with aiohttp.ClientSession() as sess:
-        async with sess.post(url, headers=_headers(), data=json.dumps(payload)) as resp:
-            if resp.status != 200:
-                raise LLMError(f"HTTP {resp.status}: {await resp.text()}")
-            data = await resp.json()
-            # OpenAI 兼容：choices[0].message.content
-            try:
-                return data["choices"][0]["message"]["content"]
-            except Exception:
-                raise LLMError(f"Unexpected response: {data}")
+    async with _admit():
+        resp = await get_http_client().post(url, content=jsonutil.dumps(payload))
+    if resp.status_code != 200:
+        raise LLMError(f"HTTP {resp.status_code}: {resp.text}")
+    data = jsonutil.loads(resp.content)
+    # OpenAI 兼容：choices[0].message.content
+    try:
+        return data["choices"][0]["message"]["content"]
+    except Exception:
+        raise LLMError(f"Unexpected response: {data}")
 
 
 async def chat_completion_stream(messages: List[Dict[str, str]], model: Optional[str] = None) -> AsyncGenerator[str, None]:
@@ -76,24 +152,31 @@ async def chat_completion_stream(messages: List[Dict[str, str]], model: Optional
         "stream": True,
     }
 
-    async with aiohttp.ClientSession() as sess:
-        async with sess.post(url, headers=_headers(), data=json.dumps(payload)) as resp:
-            if resp.status != 200:
-                raise LLMError(f"HTTP {resp.status}: {await resp.text()}")
-
-            async for raw, _ in resp.content.iter_chunks():
-                if not raw:
-                    continue
-                # OpenAI 流式是典型 SSE，每行以 "data: " 开头
-                for line in raw.decode("utf-8", errors="ignore").splitlines():
-                    line = line.strip()
-                    if not line.startswith("data:"):
+    async with _admit():
+        async with get_http_client().stream("POST", url, headers=_SSE_HEADERS, content=jsonutil.dumps(payload)) as resp:
+            if resp.status_code != 200:
+                await resp.aread()
+                raise LLMError(f"HTTP {resp.status_code}: {resp.text}")
+
+            # OpenAI 流式是典型 SSE，每行以 "data: " 开头。
+            # 直接在 bytearray 上按 b"\n" 切行（find + 切片都在 C 层完成），
+            # 不走 aiter_lines 的逐行解码；行被网络分块截断时留在 buf 里等下一块
+            buf = bytearray()
+            async for raw in resp.aiter_bytes():
+                buf += raw
+                while (i := buf.find(b"\n")) != -1:
+                    line = bytes(buf[:i]).strip()
+                    del buf[:i + 1]
+                    if not line.startswith(b"data:"):
                         continue
-                    data_str = line[len("data:"):].strip()
-                    if data_str == "[DONE]":
+                    data = line[5:].strip()
+                    if data == b"[DONE]":
                         return
+                    # 只有带 content 的帧才需要解析；role/finish_reason/usage 等帧直接跳过，不做 JSON 解码
+                    if b'"content"' not in data:
+                        continue
                     try:
-                        obj = json.loads(data_str)
+                        obj = jsonutil.loads(data)
                         # 兼容 OpenAI：choices[0].delta.content
                         delta = obj.get("choices", [{}])[0].get("delta", {})
                         chunk = delta.get("content", "")
@@ -1,18 +1,48 @@
-# --- START OF FILE redis_cache.py ---
-
 # -*- coding: utf-8 -*-
 """
 Redis 缓存封装
-- 优先使用 redis.asyncio（需要 redis>=4.2）
-- 若环境不支持，则自动回退到同步 redis，并通过线程池适配到异步接口
+- 使用 redis.asyncio（需要 redis>=4.2），共享一个有上限的连接池
 """
 import os
-import json
-import asyncio # Add this import for ThreadPoolExecutor fallbacks
+import secrets
+from itertools import islice
+
+from typing import List, Dict, Any, Iterable, Optional
 
-from typing import List, Dict, Any
+import redis.asyncio as redis  # 需要 redis>=4.2
+from redis.asyncio.client import Redis
+
+from .jsonutil import dumps as _dumps, loads as _loads
+
+# 可选压缩：装了 zstandard 时，超过 HISTORY_COMPRESS_MIN_BYTES 的历史消息以 zstd 帧存储；
+# 读取时按 zstd 魔数识别，未压缩的旧数据照常解析（可平滑上线 / 回滚）
+HISTORY_COMPRESS_MIN_BYTES = int(os.getenv("HISTORY_COMPRESS_MIN_BYTES", "1024"))
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+try:
+    import zstandard
+
+    _zstd_c = zstandard.ZstdCompressor(level=3)
+    _zstd_d = zstandard.ZstdDecompressor()
+except ImportError:
+    _zstd_c = _zstd_d = None
+
+def _pack(msg: Dict[str, Any]) -> bytes:
+    blob = _dumps(msg)
+    if _zstd_c is not None and len(blob) >= HISTORY_COMPRESS_MIN_BYTES:
+        return _zstd_c.compress(blob)
+    return blob
+
+def _unpack(raw: bytes) -> Dict[str, Any]:
+    if raw[:4] == _ZSTD_MAGIC:
+        if _zstd_d is None:
+            raise ValueError("zstd-compressed history but zstandard is not installed")
+        raw = _zstd_d.decompress(raw)
+    return _loads(raw)
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://127.0.0.1:6379/0")
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "64"))
+# 连接池用满时，新命令最多等这么久拿空闲连接（秒），超时才报错
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "5"))
 
 # 配置：每个会话最多保留最近 N 轮（每轮两条：user/assistant）
 MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", "20"))
@@ -21,118 +51,156 @@ TTL_SECONDS = int(os.getenv("HISTORY_TTL_SECONDS", "259200"))  # 3 天
 # 新增：会话锁的 TTL
 SESSION_LOCK_TTL_SECONDS = int(os.getenv("SESSION_LOCK_TTL_SECONDS", "60")) # 默认 60 秒
 
+# 角色行缓存的 TTL（character_info 几乎只读）
+CHARACTER_TTL_SECONDS = int(os.getenv("CHARACTER_TTL_SECONDS", "3600"))
+
+# 会话列表缓存的 TTL：写路径会主动失效，短 TTL 只用来兜底限制陈旧时间
+SESSIONS_LIST_TTL_SECONDS = int(os.getenv("SESSIONS_LIST_TTL_SECONDS", "5"))
+
+# 释放会话锁：只有值仍是自己的 token 才删除（锁已过期并被别的请求拿到时不误删）
+_RELEASE_LOCK_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+else
+    return 0
+end
+"""
+
+# 一轮对话收尾：追加问答 + 裁剪 + 续期 + 失效会话列表 + 按 token 释放会话锁，一条 EVALSHA 原子完成
+# KEYS: 历史 / 会话锁 / 会话列表缓存；ARGV: user 条目, assistant 条目, 保留条数, TTL, 锁 token
+_FINALIZE_TURN_LUA = """
+redis.call('rpush', KEYS[1], ARGV[1], ARGV[2])
+redis.call('ltrim', KEYS[1], -tonumber(ARGV[3]), -1)
+redis.call('expire', KEYS[1], ARGV[4])
+redis.call('del', KEYS[3])
+if redis.call('get', KEYS[2]) == ARGV[5] then
+    redis.call('del', KEYS[2])
+end
+return redis.call('llen', KEYS[1])
+"""
+
+# 会话列表缓存：一个 HASH，field = limit，value = 已序列化的 JSON；失效时 DEL 整个 key
+_SESSIONS_LIST_KEY = "sessions:list"
+
 def _key(session_id: str) -> str:
-    return f"chat:hist:{session_id}"
+    # 历史以 Redis LIST 存储（每条消息一个元素）；
+    # 与旧版整段 JSON 字符串的 key 区分开，旧 key 靠 TTL 自然过期
+    return f"chat:hlist:{session_id}"
 
 def _lock_key(session_id: str) -> str: # 新增：锁的 key
     return f"chat:lock:{session_id}"
 
-# ========= 优先尝试异步 redis（redis>=4.2 提供 redis.asyncio） =========
-try:
-    import redis.asyncio as redis  # type: ignore
-    from redis.asyncio.client import Redis # Type hinting for Redis client
-
-    _ASYNC = True
-    _client: Redis = redis.from_url(REDIS_URL, decode_responses=True)
-
-    def get_redis():
-        """FastAPI 依赖：返回异步 redis 客户端"""
-        # asyncio 版客户端是连接池，不必每次关闭
-        yield _client
-
-    async def get_history(rds: Redis, session_id: str) -> List[Dict[str, Any]]:
-        raw = await rds.get(_key(session_id))
-        if not raw:
-            return []
-        try:
-            return json.loads(raw)
-        except Exception:
-            return []
-
-    async def set_history(rds: Redis, session_id: str, history: List[Dict[str, Any]]):
-        if len(history) > MAX_TURNS * 2:
-            history = history[-MAX_TURNS*2:]
-        await rds.set(_key(session_id), json.dumps(history, ensure_ascii=False), ex=TTL_SECONDS)
-
-    async def append_pair(rds: Redis, session_id: str, user_msg: str, assistant_msg: str):
-        hist = await get_history(rds, session_id)
-        hist.extend([
-            {"role": "user", "content": user_msg},
-            {"role": "assistant", "content": assistant_msg},
-        ])
-        await set_history(rds, session_id, hist)
-
-    async def delete_history(rds: Redis, session_id: str):
-        """从 Redis 删除指定会话的历史记录"""
-        await rds.delete(_key(session_id))
-
-    # 新增：获取会话锁
-    async def acquire_session_lock(rds: Redis, session_id: str) -> bool:
-        """尝试获取会话锁，成功返回 True，否则返回 False"""
-        # value 可以是任意唯一标识符，但对于简单的锁，1 即可
-        # SET key value NX EX seconds
-        return await rds.set(_lock_key(session_id), 1, nx=True, ex=SESSION_LOCK_TTL_SECONDS)
-
-    # 新增：释放会话锁
-    async def release_session_lock(rds: Redis, session_id: str):
-        """释放会话锁"""
-        await rds.delete(_lock_key(session_id))
-
-except Exception:
-    # ========= 回退到同步 redis，适配异步接口 =========
-    import redis  # 同步客户端
-    from concurrent.futures import ThreadPoolExecutor
-
-    _ASYNC = False
-    _sync_client = redis.from_url(REDIS_URL, decode_responses=True)
-    _executor = ThreadPoolExecutor(max_workers=8)
-
-    def get_redis():
-        """FastAPI 依赖：返回一个“伪异步”的句柄（其实内部用同步客户端）"""
-        # 为了接口一致性，这里返回同步客户端本身
-        yield _sync_client
-
-    async def _run_in_thread(func, *args, **kwargs):
-        loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(_executor, lambda: func(*args, **kwargs))
-
-    async def get_history(rds, session_id: str) -> List[Dict[str, Any]]:
-        raw = await _run_in_thread(rds.get, _key(session_id))
-        if not raw:
-            return []
-        try:
-            return json.loads(raw)
-        except Exception:
-            return []
-
-    async def set_history(rds, session_id: str, history: List[Dict[str, Any]]):
-        if len(history) > MAX_TURNS * 2:
-            history = history[-MAX_TURNS*2:]
-        data = json.dumps(history, ensure_ascii=False)
-        # 兼容同步 set 的 ex 参数
-        await _run_in_thread(rds.set, _key(session_id), data, ex=TTL_SECONDS)
-
-    async def append_pair(rds, session_id: str, user_msg: str, assistant_msg: str):
-        hist = await get_history(rds, session_id)
-        hist.extend([
-            {"role": "user", "content": user_msg},
-            {"role": "assistant", "content": assistant_msg},
-        ])
-        await set_history(rds, session_id, hist)
-
-    async def delete_history(rds, session_id: str):
-        """从 Redis 删除指定会话的历史记录"""
-        await _run_in_thread(rds.delete, _key(session_id))
-
-    # 新增：获取会话锁
-    async def acquire_session_lock(rds, session_id: str) -> bool:
-        """尝试获取会话锁，成功返回 True，否则返回 False"""
-        # SET key value NX EX seconds
-        return await _run_in_thread(rds.set, _lock_key(session_id), 1, nx=True, ex=SESSION_LOCK_TTL_SECONDS)
-
-    # 新增：释放会话锁
-    async def release_session_lock(rds, session_id: str):
-        """释放会话锁"""
-        await _run_in_thread(rds.delete, _lock_key(session_id))
-
-# --- END OF FILE redis_cache.py ---
\ No newline at end of file
+def _char_id_key(cid: int) -> str:
+    return f"char:id:{cid}"
+
+def _char_name_key(name: str) -> str:
+    # 名字统一 strip + lower，与 characters.get_character_by_name 的大小写不敏感匹配一致
+    return f"char:name:{name.strip().lower()}"
+
+def _char_key(cid: Optional[int], name: Optional[str]) -> str:
+    return _char_id_key(cid) if cid is not None else _char_name_key(name or "")
+
+# ========= 异步 redis：全进程共享一个连接池 =========
+# 连接上限需与并发量匹配；用满时排队等空闲连接（BlockingConnectionPool），而不是直接抛 Too many connections；
+# health_check_interval 让空闲过久的连接在复用前先 PING 一次
+_pool = redis.BlockingConnectionPool.from_url(
+    REDIS_URL,
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT,
+    health_check_interval=30,
+    decode_responses=False,  # 取回的 bytes 直接交给 orjson，省去一次 decode + encode
+)
+_client: Redis = redis.Redis(connection_pool=_pool)
+_release_lock_script = _client.register_script(_RELEASE_LOCK_LUA)
+_finalize_turn_script = _client.register_script(_FINALIZE_TURN_LUA)
+
+async def get_redis() -> Redis:
+    """FastAPI 依赖：返回异步 redis 客户端"""
+    # async 且不 yield：FastAPI 直接在事件循环里调用，不为同步生成器依赖走两次线程池；
+    # asyncio 版客户端是连接池，不必每次关闭
+    return _client
+
+async def get_history(rds: Redis, session_id: str) -> List[Dict[str, Any]]:
+    raw = await rds.lrange(_key(session_id), 0, -1)
+    try:
+        return [_unpack(x) for x in raw]
+    except Exception:
+        return []
+
+async def set_history(rds: Redis, session_id: str, history: List[Dict[str, Any]]):
+    """整体覆盖会话历史（用于 DB 兜底后回填）"""
+    # 只序列化最后 MAX_TURNS*2 条：islice 直接跳过开头，不先切出一份列表副本
+    start = max(len(history) - MAX_TURNS * 2, 0)
+    items = [_pack(m) for m in islice(history, start, None)]
+    key = _key(session_id)
+    async with rds.pipeline(transaction=True) as p:
+        p.delete(key)
+        if items:
+            p.rpush(key, *items)
+            p.expire(key, TTL_SECONDS)
+        await p.execute()
+
+async def delete_history(rds: Redis, session_id: str):
+    """从 Redis 删除指定会话的历史记录（连同可能残留的会话锁）"""
+    await rds.delete(_key(session_id), _lock_key(session_id))
+
+# 新增：获取会话锁
+async def acquire_session_lock(rds: Redis, session_id: str) -> Optional[str]:
+    """尝试获取会话锁，成功返回本次持有的 token，否则返回 None"""
+    # SET key token NX EX seconds；token 用于释放时校验所有权
+    token = secrets.token_hex(16)
+    ok = await rds.set(_lock_key(session_id), token, nx=True, ex=SESSION_LOCK_TTL_SECONDS)
+    return token if ok else None
+
+# 新增：释放会话锁
+async def release_session_lock(rds: Redis, session_id: str, token: str):
+    """释放会话锁（Lua 比较并删除，一次往返）"""
+    await _release_lock_script(keys=[_lock_key(session_id)], args=[token], client=rds)
+
+async def finalize_turn(rds: Redis, session_id: str, token: str, user_msg: str, assistant_msg: str):
+    """
+    一轮对话收尾（落库之后调用）：追加问答 + 释放会话锁 + 失效会话列表缓存，
+    一次 EVALSHA 完成，历史写入与锁释放原子生效
+    """
+    await _finalize_turn_script(
+        keys=[_key(session_id), _lock_key(session_id), _SESSIONS_LIST_KEY],
+        args=[
+            _pack({"role": "user", "content": user_msg}),
+            _pack({"role": "assistant", "content": assistant_msg}),
+            MAX_TURNS * 2,
+            TTL_SECONDS,
+            token,
+        ],
+        client=rds,
+    )
+
+async def get_cached_character(rds: Redis, cid: Optional[int] = None, name: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """按 id（优先）或名字读取缓存的角色行，未命中返回 None"""
+    raw = await rds.get(_char_key(cid, name))
+    return _loads(raw) if raw else None
+
+async def set_cached_character(rds: Redis, char: Dict[str, Any]):
+    """同时写入 id / name 两个 key"""
+    blob = _dumps(char)
+    async with rds.pipeline(transaction=False) as p:
+        p.set(_char_id_key(char["id"]), blob, ex=CHARACTER_TTL_SECONDS)
+        p.set(_char_name_key(char["name"]), blob, ex=CHARACTER_TTL_SECONDS)
+        await p.execute()
+
+async def delete_cached_character(rds: Redis, cid: int, names: Iterable[str] = ()):
+    """角色被修改后调用：删除 id key 及给出的名字 key"""
+    await rds.delete(_char_id_key(cid), *[_char_name_key(n) for n in names])
+
+async def get_cached_sessions(rds: Redis, limit: int) -> Optional[bytes]:
+    """读取缓存的会话列表 JSON（原样返回，不反序列化）"""
+    return await rds.hget(_SESSIONS_LIST_KEY, str(limit))
+
+async def set_cached_sessions(rds: Redis, limit: int, payload: bytes):
+    async with rds.pipeline(transaction=False) as p:
+        p.hset(_SESSIONS_LIST_KEY, str(limit), payload)
+        p.expire(_SESSIONS_LIST_KEY, SESSIONS_LIST_TTL_SECONDS)
+        await p.execute()
+
+async def invalidate_sessions_cache(rds: Redis):
+    """会话新增/活跃时间/标题/角色变化后调用"""
+    await rds.delete(_SESSIONS_LIST_KEY)
@@ -1,5 +1,3 @@
-# --- START OF FILE main.py ---
-
 # -*- coding: utf-8 -*-
 """
 项目根目录的 main.py（与 app/ 目录同级）
@@ -10,47 +8,150 @@
 - 模型选择：优先 本轮指定 -> 会话默认(如实现) -> 全局默认（.env 的 LLM_MODEL）
 """
 
-import json
+import os
+import time
+import asyncio
 import logging
-from typing import Optional, List, Dict
+from datetime import datetime
+from typing import Annotated, Optional, List, Dict, Tuple
 
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, BackgroundTasks, Depends, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
+from sqlalchemy import select, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
 # ✅ 绝对导入 app 包内模块（确保 app/ 下有 __init__.py）
-from app.database import get_db
+from app.database import get_db, SessionLocal
+from app import jsonutil
+from app.jsonutil import sse_data
 # 导入新增的锁相关函数
-from app.redis_cache import get_redis, get_history, append_pair, delete_history, acquire_session_lock, release_session_lock
-from app.characters import build_system_prompt
+from app.redis_cache import (
+    Redis,
+    get_redis,
+    get_history,
+    set_history,
+    finalize_turn,
+    delete_history,
+    acquire_session_lock,
+    release_session_lock,
+    get_cached_sessions,
+    set_cached_sessions,
+    invalidate_sessions_cache,
+)
+from app.characters import (
+    build_system_prompt,
+    list_character_dicts,
+    get_character,
+    invalidate_prompt_cache,
+    invalidate_character,
+    reload_characters,
+    _normalize_name,
+)
 from app.crud import (
+    _MAX_MESSAGE_ID,
     add_turn,
     load_history_from_db,
     list_sessions,
     list_messages,
+    bind_session_character,
     rename_session,
     delete_session,
 )
-from app.qiniu_llm import chat_completion, chat_completion_stream
+from app.qiniu_llm import (
+    LLMError,
+    chat_completion,
+    chat_completion_stream,
+    list_model_ids,
+    get_http_client,
+    close_http_client,
+)
 from app.models import CharacterInfo, ChatSession
 
 logger = logging.getLogger(__name__)
 
+# 依赖的类型别名：各路由共用同一个 Depends 对象（同一请求内同一依赖只解析一次）
+DbDep = Annotated[AsyncSession, Depends(get_db)]
+RedisDep = Annotated[Redis, Depends(get_redis)]
+
+# Redis 无历史时从 DB 兜底读取的条数（对话上下文只需最近几条）
+HISTORY_DB_TAIL = int(os.getenv("HISTORY_DB_TAIL", "6"))
+
+# 会话列表返回条数（/sessions 固定取最近活跃的这么多条）
+SESSIONS_LIST_LIMIT = 200
+
+# 进程内角色表的定时刷新间隔（秒）
+CHARACTER_RELOAD_SECONDS = int(os.getenv("CHARACTER_RELOAD_SECONDS", "300"))
+
+# SSE 攒批：凑够 4KB 或距上次下发超过 16ms 才 yield 一次，减少逐 token 的写出/调度开销；
+# 上游停顿时已攒的数据也最迟 16ms 内下发
+SSE_FLUSH_BYTES = 4096
+SSE_FLUSH_INTERVAL = 0.016  # 秒
+
+# SSE 内容帧模板：data: {"content":<chunk>}\n\n，逐块只需编码一个字符串
+_SSE_PREFIX = b'data: {"content":'
+_SSE_SUFFIX = b'}\n\n'
+_SSE_DONE = b"data: [DONE]\n\n"
+_SSE_OPEN = b": go\n\n"
+_SSE_PING = b": ping\n\n"
+
+# 上游长时间没有新内容时每隔多少秒发一次 SSE 注释行，防止代理因空闲断开连接
+SSE_PING_SECONDS = int(os.getenv("SSE_PING_SECONDS", "15"))
+
+# /chat/stream 的响应头：禁止缓存，并让 nginx 等反向代理不缓冲、逐块转发
+_SSE_RESPONSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
 # =========================
 # FastAPI 初始化与中间件
 # =========================
-app = FastAPI(title="AI 角色扮演聊天后端", version="0.2.0")
+# 默认响应用 FastAPI 自带的 ORJSONResponse；热点接口直接 return ORJSONResponse(...)，
+# FastAPI 对 Response 对象原样返回，跳过 jsonable_encoder 的逐字段遍历
+app = FastAPI(
+    title="AI 角色扮演聊天后端",
+    version="0.2.0",
+    default_response_class=ORJSONResponse,
+)
 
-# 开放跨域（按需收紧 allow_origins）
+# 跨域：CORS_ALLOW_ORIGINS 逗号分隔（如 http://localhost:5173），默认 * 保持开放；
+# 方法 / 请求头用具体列表（前端只用到这些），预检由中间件直接应答，不必逐个回显请求头
+CORS_ALLOW_ORIGINS = [o.strip() for o in os.getenv("CORS_ALLOW_ORIGINS", "*").split(",") if o.strip()]
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=CORS_ALLOW_ORIGINS,
+    allow_methods=["GET", "POST", "PATCH", "DELETE"],
+    allow_headers=["Content-Type", "Authorization"],
+    max_age=int(os.getenv("CORS_MAX_AGE", "3600")),  # 浏览器缓存预检结果的秒数
 )
 
+async def _load_characters() -> None:
+    try:
+        async with SessionLocal() as db:
+            n = await reload_characters(db)
+        logger.info("loaded %d characters", n)
+    except Exception:
+        # 载入失败不影响服务：查询会回落到 Redis / DB
+        logger.exception("load characters failed")
+
+async def _character_reload_loop() -> None:
+    while True:
+        await asyncio.sleep(CHARACTER_RELOAD_SECONDS)
+        await _load_characters()
+
+@app.on_event("startup")
+async def _startup():
+    # 预先创建上游 HTTP 连接池（全进程共享），首个请求不必再付创建成本
+    get_http_client()
+    # 角色表载入进程内存，并定期刷新
+    await _load_characters()
+    app.state.character_reloader = asyncio.create_task(_character_reload_loop())
+
+@app.on_event("shutdown")
+async def _shutdown():
+    app.state.character_reloader.cancel()
+    await close_http_client()
+
 # =========================
 # Pydantic 入参模型
 # =========================
@@ -101,77 +202,142 @@ def _choose_model(body_model: Optional[str]) -> Optional[str]:
         return None
     return val
 
-def _fill_bound_character_if_absent(db: Session, body: ChatIn) -> None:
+async def _fill_bound_character_if_absent(db: AsyncSession, rds, body: ChatIn) -> None:
     """
-    如果本次请求没传角色，则尝试从会话绑定里取（chat_sessions.character_id）
+    如果本次请求没传角色，则尝试从会话绑定里取（chat_sessions.character_id）；
+    只传了角色名时解析出 character_id，落库时会话才能关联到角色
     """
     if (body.character_id is None) and (not body.character_name):
-        s = db.get(ChatSession, body.session_id)
-        if s and s.character_id:
-            body.character_id = s.character_id
+        # 只取一列，不构造 ChatSession 对象
+        cid = (await db.execute(
+            select(ChatSession.character_id).where(ChatSession.id == body.session_id)
+        )).scalar_one_or_none()
+        if cid:
+            body.character_id = cid
+    elif body.character_id is None:
+        char = await get_character(db, rds, character_name=body.character_name)
+        if char:
+            body.character_id = char["id"]
+
+async def _resolve_system_prompt(db: AsyncSession, rds, body: ChatIn) -> str:
+    """补全会话绑定的角色，再组装 system prompt（只用 DB / 角色缓存，可与读历史并发）"""
+    await _fill_bound_character_if_absent(db, rds, body)
+    return await build_system_prompt(db, rds, body.character_name, body.character_id)
+
+async def _build_messages(db: AsyncSession, rds, body: ChatIn) -> List[Dict[str, str]]:
+    """
+    1) 会话历史（Redis）与 2)+3) 绑定角色 / system prompt（DB + 角色缓存）互不依赖，并发进行
+    Redis 无历史时再用 DB 尾部兜底，并回填 Redis
+    """
+    history, system_prompt = await asyncio.gather(
+        get_history(rds, body.session_id),
+        _resolve_system_prompt(db, rds, body),
+    )
+    if not history:
+        history = await load_history_from_db(db, body.session_id, tail=HISTORY_DB_TAIL)
+        if history:
+            # 回填 Redis：之后的轮次直接命中缓存，不再回源 DB
+            await set_history(rds, body.session_id, history)
+    return assemble_messages(system_prompt, history, body.message)
+
+async def _prepare_call(db: AsyncSession, rds, body: ChatIn) -> Tuple[List[Dict[str, str]], Optional[str]]:
+    """
+    /chat 与 /chat/stream 共用：返回 (messages, 清洗后的模型名；None 表示用上游默认模型)
+    读库到此为止：随即关闭会话，把连接还给连接池，不让它在调用大模型期间 idle in transaction
+    占着一个池位；之后再用这个会话（/chat/stream 的 add_turn）会自动重新取连接
+    """
+    messages = await _build_messages(db, rds, body)
+    await db.close()
+    return messages, _choose_model(body.model)
+
+async def _persist_turn(
+    rds,
+    *,
+    session_id: str,
+    character_id: Optional[int],
+    user_msg: str,
+    assistant_msg: str,
+) -> None:
+    """
+    /chat 的后台落库，单独开一个会话。
+    注意 FastAPI 0.99 先跑后台任务、后清理 yield 依赖：请求作用域的 db 此时还没被依赖关闭，
+    /chat 必须在返回前自己释放它的连接，否则这里会和它抢池位（池满时等到超时，这一轮丢失）。
+    Redis 历史与会话锁已在返回前由 finalize_turn 处理；同一会话的写入由 add_turn 的 advisory lock 排队。
+    落库后再失效一次会话列表缓存（落库前被重新缓存的列表还不含这一轮）
+    """
+    try:
+        async with SessionLocal() as db:
+            await add_turn(
+                db,
+                session_id=session_id,
+                character_id=character_id,
+                user_msg=user_msg,
+                assistant_msg=assistant_msg,
+            )
+        await invalidate_sessions_cache(rds)
+    except Exception:
+        logger.error("persist chat turn failed (session=%s)", session_id, exc_info=True)
 
 # =========================
 # 路由：非流式聊天
 # =========================
 @app.post("/chat")
-async def chat(body: ChatIn, db=Depends(get_db), rds=Depends(get_redis)):
+async def chat(body: ChatIn, background: BackgroundTasks, db: DbDep, rds: RedisDep):
     """
     非流式回复：
     1) 读取会话历史（优先 Redis，缺失用 DB 兜底）
     2) 若未显式传角色 -> 尝试使用会话已绑定角色
     3) 组装 system prompt + 历史 + 用户消息
     4) 请求大模型得到完整回复
-    5) 写回 Redis + 落库两条（user/assistant）
+    5) 写回 Redis + 释放会话锁后返回；两条记录（user/assistant）在响应发出后由后台任务落库
     """
     if not body.session_id:
         raise HTTPException(status_code=400, detail="session_id required")
 
     # --- 并发控制：尝试获取会话锁 ---
-    lock_acquired = await acquire_session_lock(rds, body.session_id)
-    if not lock_acquired:
+    lock_token = await acquire_session_lock(rds, body.session_id)
+    if not lock_token:
         raise HTTPException(status_code=409, detail="会话正在处理中，请稍后再试。") # 409 Conflict
 
     try:
-        # 1) 会话历史
-        history = await get_history(rds, body.session_id)
-        if not history:
-            history = load_history_from_db(db, body.session_id, limit=100)
+        # 1)~3) 历史 + 绑定角色 + system prompt -> messages；模型名清洗
+        messages, chosen_model = await _prepare_call(db, rds, body)
 
-        # 2) 会话绑定角色（若未显式传）
-        _fill_bound_character_if_absent(db, body)
-
-        # 3) system prompt（基于角色人设）
-        system_prompt = build_system_prompt(db, body.character_name, body.character_id)
-        messages = assemble_messages(system_prompt, history, body.message)
-
-        # 4) 调大模型（带模型清洗）
-        chosen_model = _choose_model(body.model)
+        # 4) 调大模型
         try:
             reply = await chat_completion(messages, model=chosen_model)
+        except LLMError as e:
+            # 上游返回的业务错误（非 200 / 响应格式不对）：原因都在消息里，不必格式化堆栈
+            logger.error("LLM upstream error: %s", e)
+            raise HTTPException(status_code=502, detail=f"LLM upstream error: {e}")
         except Exception as e:
-            logger.exception("LLM upstream error")
+            logger.error("LLM upstream error", exc_info=True)
             raise HTTPException(status_code=502, detail=f"LLM upstream error: {e}")
 
-        # 5) 写缓存 + 落库
-        await append_pair(rds, body.session_id, body.message, reply)
-        add_turn(
-            db,
+        # 5) 返回前一次往返写回 Redis 历史 + 释放锁：客户端紧接着发下一轮不会 409，上下文也已包含这一轮
+        await finalize_turn(rds, body.session_id, lock_token, body.message, reply)
+        lock_token = None
+        # 落库交给后台任务，不占响应时间。后台任务先于依赖清理执行，
+        # 这里确保请求的 db 不再持有连接（_prepare_call 已关闭；再次 close 是空操作）
+        await db.close()
+        background.add_task(
+            _persist_turn, rds,
             session_id=body.session_id,
             character_id=body.character_id,
-            character_name=body.character_name,
             user_msg=body.message,
             assistant_msg=reply,
         )
-        return {"reply": reply}
+        return ORJSONResponse({"reply": reply})
     finally:
-        # --- 并发控制：无论成功失败，都释放锁 ---
-        await release_session_lock(rds, body.session_id)
+        # --- 并发控制：中途失败时释放锁（正常路径已在 finalize_turn 中释放） ---
+        if lock_token:
+            await release_session_lock(rds, body.session_id, lock_token)
 
 # =========================
 # 路由：流式聊天（SSE）
 # =========================
 @app.post("/chat/stream")
-async def chat_stream(body: ChatIn, db=Depends(get_db), rds=Depends(get_redis)):
+async def chat_stream(body: ChatIn, db: DbDep, rds: RedisDep):
     """
     流式回复（Server-Sent Events）：
     - 逐段返回 content 字段，完成后发送 [DONE]
@@ -181,170 +347,272 @@ async def chat_stream(body: ChatIn, db=Depends(get_db), rds=Depends(get_redis)):
         raise HTTPException(status_code=400, detail="session_id required")
 
     # --- 并发控制：尝试获取会话锁 ---
-    lock_acquired = await acquire_session_lock(rds, body.session_id)
-    if not lock_acquired:
+    lock_token = await acquire_session_lock(rds, body.session_id)
+    if not lock_token:
         raise HTTPException(status_code=409, detail="会话正在处理中，请稍后再试。") # 409 Conflict
 
     async def gen():
-        full_reply_content = [] # 收集完整回复
+        full_reply = bytearray()  # 以 UTF-8 字节累积完整回复，结束时一次 decode
+        finalized = False
         try:
-            # 1) 会话历史
-            history = await get_history(rds, body.session_id)
-            if not history:
-                history = load_history_from_db(db, body.session_id, limit=100)
-
-            # 2) 会话绑定角色（若未显式传）
-            _fill_bound_character_if_absent(db, body)
-
-            # 3) system prompt
-            system_prompt = build_system_prompt(db, body.character_name, body.character_id)
-            messages = assemble_messages(system_prompt, history, body.message)
-
-            chosen_model = _choose_model(body.model)
-
+            # 先发一行 SSE 注释把响应头和首包立即推给客户端（前端忽略非 data: 行），
+            # 不必等读历史 / 组 prompt / 上游首个 token
+            yield _SSE_OPEN
+            # 1)~3) 历史 + 绑定角色 + system prompt -> messages；模型名清洗
+            messages, chosen_model = await _prepare_call(db, rds, body)
+
+            upstream = chat_completion_stream(messages, model=chosen_model)
+            buf = bytearray()
+            # 读取任务置位：buf 由空变非空（新一批开始）、攒够 SSE_FLUSH_BYTES、或上游结束
+            ready = asyncio.Event()
+
+            async def pump():
+                """整条流只有这一个读取任务：逐段读上游，成帧攒进 buf，不为每个 token 唤醒下发循环"""
+                try:
+                    async for chunk in upstream:
+                        was_empty = not buf
+                        full_reply.extend(chunk.encode("utf-8"))
+                        # SSE 格式：以 data: 开头，空行分隔；先攒进 buf 再批量下发
+                        buf.extend(_SSE_PREFIX + jsonutil.dumps(chunk) + _SSE_SUFFIX)
+                        if was_empty or len(buf) >= SSE_FLUSH_BYTES:
+                            ready.set()
+                finally:
+                    ready.set()
+
+            reader = asyncio.ensure_future(pump())
+            last_flush = time.monotonic()
             try:
-                async for chunk in chat_completion_stream(messages, model=chosen_model):
-                    full_reply_content.append(chunk)
-                    # SSE 格式：以 data: 开头，空行分隔
-                    yield f"data: {json.dumps({'content': chunk}, ensure_ascii=False)}\n\n"
+                while not reader.done():
+                    # buf 为空：最多等一个保活间隔，期间来了新一批就醒；
+                    # buf 非空：睡到本批截止（上游停顿也按时下发），攒够 SSE_FLUSH_BYTES 或上游结束时提前醒
+                    if not buf:
+                        timeout = SSE_PING_SECONDS
+                    elif len(buf) >= SSE_FLUSH_BYTES:
+                        timeout = 0
+                    else:
+                        timeout = SSE_FLUSH_INTERVAL - (time.monotonic() - last_flush)
+                    if timeout > 0:
+                        ready.clear()
+                        try:
+                            await asyncio.wait_for(ready.wait(), timeout)
+                        except asyncio.TimeoutError:
+                            pass
+                    if buf:
+                        now = time.monotonic()
+                        if len(buf) >= SSE_FLUSH_BYTES or now - last_flush >= SSE_FLUSH_INTERVAL:
+                            yield bytes(buf)
+                            buf.clear()
+                            last_flush = now
+                    elif not reader.done():
+                        # 上游一个保活间隔内没有新内容：发一行注释防止代理断开空闲连接
+                        yield _SSE_PING
+                # 上游异常在这里抛出
+                reader.result()
             except Exception as e:
-                logger.exception("LLM upstream error (stream)")
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
+                if isinstance(e, LLMError):
+                    logger.error("LLM upstream error (stream): %s", e)
+                else:
+                    logger.error("LLM upstream error (stream)", exc_info=True)
+                buf += sse_data({"error": str(e)})
                 # 即使有错误，也发送 DONE 标记，让前端知道流结束
-                yield "data: [DONE]\n\n"
+                buf += _SSE_DONE
+                yield bytes(buf)
                 return # 异常时不再进行后续的数据库和Redis操作
-
-            full_text = "".join(full_reply_content)
-            # 写缓存 + 落库
-            await append_pair(rds, body.session_id, body.message, full_text)
-            add_turn(
+            finally:
+                # 客户端断开等提前退出：在这里取消并等读取任务结束，上游流随之关闭并归还并发名额
+                if not reader.done():
+                    reader.cancel()
+                    await asyncio.wait((reader,))
+                elif not reader.cancelled():
+                    reader.exception()  # 已取走异常，避免 "Task exception was never retrieved"
+
+            # 把尚未下发的尾部先推给前端，再落库
+            if buf:
+                yield bytes(buf)
+
+            full_text = full_reply.decode("utf-8")
+            # 落库，再一次往返写缓存 + 释放锁 + 失效会话列表
+            await add_turn(
                 db,
                 session_id=body.session_id,
                 character_id=body.character_id,
-                character_name=body.character_name,
                 user_msg=body.message,
                 assistant_msg=full_text,
             )
+            await finalize_turn(rds, body.session_id, lock_token, body.message, full_text)
+            finalized = True
             # 结束标记
-            yield "data: [DONE]\n\n"
+            yield _SSE_DONE
 
         finally:
-            # --- 并发控制：无论成功失败，都释放锁 ---
-            await release_session_lock(rds, body.session_id)
+            # --- 并发控制：中途失败时释放锁（正常路径已在 finalize_turn 中释放） ---
+            if not finalized:
+                await release_session_lock(rds, body.session_id, lock_token)
 
 
-    return StreamingResponse(gen(), media_type="text/event-stream; charset=utf-8")
+    # 直接用 StreamingResponse：gen() 产出的已是成帧的 bytes，原样写出；
+    # 保活注释行由 gen() 自己在上游空闲时发出（前端忽略非 data: 行）
+    return StreamingResponse(gen(), media_type="text/event-stream", headers=_SSE_RESPONSE_HEADERS)
 
 # =========================
 # 路由：角色管理
 # =========================
 @app.get("/characters")
-def list_characters(db: Session = Depends(get_db)):
+async def list_characters(db: DbDep):
     """
     列出所有可选角色（包含基本设定，便于前端展示）
     """
-    rows = db.query(CharacterInfo).order_by(CharacterInfo.id.asc()).all()
-    return [
-        {
-            "id": r.id,
-            "name": r.name,
-            "background": r.background,
-            "personality": r.personality,
-            "skills": r.skills,
-            "current_playstyle": r.current_playstyle,
-        }
-        for r in rows
-    ]
+    return ORJSONResponse(await list_character_dicts(db))
 
 @app.post("/characters")
-def create_character(body: CharacterIn, db: Session = Depends(get_db)):
+async def create_character(body: CharacterIn, db: DbDep):
     """
     新增一个角色（name 建议唯一；若重复可返回 409）
     """
-    exists = db.query(CharacterInfo).filter(CharacterInfo.name == body.name).first()
+    # 名字按 strip + lower 判重，与按名查找（DB / Redis key / 进程内表）的匹配规则一致；
+    # 走 lower(name) 唯一索引，并发创建同名时由索引兜底
+    exists = (await db.execute(
+        select(CharacterInfo.id).where(func.lower(CharacterInfo.name) == _normalize_name(body.name)).limit(1)
+    )).first()
     if exists:
         raise HTTPException(status_code=409, detail="character name already exists")
     ch = CharacterInfo(
-        name=body.name,
+        name=body.name.strip(),  # 去掉首尾空白再存，lower(name) 唯一索引才能挡住 " alice" 这类重名
         background=body.background,
         personality=body.personality,
         skills=body.skills,
         current_playstyle=body.current_playstyle,
     )
     db.add(ch)
-    db.commit()
-    db.refresh(ch)
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="character name already exists")
+    await db.refresh(ch)
+    # 之前按该名字请求过的会话可能缓存了兜底 prompt
+    invalidate_prompt_cache()
     return {"id": ch.id, "name": ch.name}
 
 @app.post("/sessions/{sid}/bind-character")
-def bind_character(sid: str, body: BindCharacterIn, db: Session = Depends(get_db)):
+async def bind_character(sid: str, body: BindCharacterIn, db: DbDep, rds: RedisDep):
     """
     将会话绑定到某个角色（之后 /chat 不传角色字段也能自动应用人设）
     """
-    # 允许通过 id 或 name 绑定；优先 id
-    char = None
-    if body.character_id is not None:
-        char = db.query(CharacterInfo).get(body.character_id)
-    elif body.character_name:
-        char = db.query(CharacterInfo).filter(CharacterInfo.name == body.character_name).first()
+    # 允许通过 id 或 name 绑定；优先 id（走进程内角色表 -> Redis -> DB）
+    char = await get_character(db, rds, body.character_id, body.character_name)
     if not char:
         raise HTTPException(status_code=404, detail="character not found")
 
-    s = db.get(ChatSession, sid)
-    if not s:
-        s = ChatSession(id=sid, character_id=char.id)
-        db.add(s)
-    else:
-        s.character_id = char.id
-    db.commit()
-    return {"session_id": sid, "character_id": char.id, "character_name": char.name}
+    await bind_session_character(db, sid, char["id"])
+    await invalidate_sessions_cache(rds)
+    return {"session_id": sid, "character_id": char["id"], "character_name": char["name"]}
+
+@app.post("/admin/characters/{cid}/invalidate")
+async def invalidate_character_cache(cid: int, db: DbDep, rds: RedisDep):
+    """
+    直接改库修改角色人设后调用：清空 Redis 中的角色行与进程内缓存的 system prompt
+    """
+    await invalidate_character(db, rds, cid)
+    # 会话列表里带着角色名
+    await invalidate_sessions_cache(rds)
+    return {"character_id": cid, "invalidated": True}
+
+@app.post("/admin/characters/reload")
+async def reload_character_table(db: DbDep):
+    """
+    重新全量载入进程内角色表（仅作用于处理该请求的 worker；其余 worker 依赖定时刷新）
+    """
+    return {"loaded": await reload_characters(db)}
 
 # =========================
 # 路由：会话列表/消息/重命名/删除
 # =========================
 @app.get("/sessions")
-def sessions(db=Depends(get_db)):
-    """会话列表：当前按最近活跃时间倒序返回（包含 title/created_at/last_active_at）"""
-    return list_sessions(db)
+async def sessions(db: DbDep, rds: RedisDep):
+    """
+    会话列表：当前按最近活跃时间倒序返回（包含 title/created_at/last_active_at）
+    结果以 JSON 原文短暂缓存在 Redis（写路径主动失效），命中时直接回传，不查库也不重新序列化
+    """
+    cached = await get_cached_sessions(rds, SESSIONS_LIST_LIMIT)
+    if cached:
+        return Response(content=cached, media_type="application/json")
+    payload = jsonutil.dumps(await list_sessions(db, limit=SESSIONS_LIST_LIMIT))
+    await set_cached_sessions(rds, SESSIONS_LIST_LIMIT, payload)
+    return Response(content=payload, media_type="application/json")
 
 @app.get("/sessions/{sid}/messages")
-def session_messages(sid: str, limit: int = 500, db=Depends(get_db)):
-    """某个会话的消息记录（升序返回）"""
-    return list_messages(db, sid, limit=limit)
+async def session_messages(
+    sid: str,
+    db: DbDep,
+    limit: int = 500,
+    after: Optional[datetime] = None,
+    after_id: Optional[int] = Query(None, ge=0, le=_MAX_MESSAGE_ID),  # chat_history.id 是 int4，越界直接 422
+):
+    """某个会话的消息记录（升序返回）；after / after_id 传上一页最后一条的 created_at / id 可继续往后加载"""
+    # chat_history.created_at 是不带时区的 timestamp，带时区的游标（如 ...Z）asyncpg 无法比较；
+    # 它也对应不到库里的本地时间，直接拒绝，要求原样回传上一页的 created_at
+    if after is not None and after.tzinfo is not None:
+        raise HTTPException(status_code=422, detail="after must be a naive timestamp (echo the previous page's created_at)")
+    return ORJSONResponse(await list_messages(db, sid, limit=limit, after=after, after_id=after_id))
 
 @app.patch("/sessions/{sid}")
-def patch_session(sid: str, body: SessionTitleIn, db: Session = Depends(get_db)):
+async def patch_session(sid: str, body: SessionTitleIn, db: DbDep, rds: RedisDep):
     """重命名会话"""
     title = (body.title or "").strip()
     if not title:
         raise HTTPException(status_code=400, detail="title is required")
     try:
-        return rename_session(db, sid, title)
+        result = await rename_session(db, sid, title)
     except ValueError:
         raise HTTPException(status_code=404, detail="session not found")
+    await invalidate_sessions_cache(rds)
+    return result
 
 @app.delete("/sessions/{sid}")
-async def remove_session(sid: str, db=Depends(get_db), rds=Depends(get_redis)):
+async def remove_session(sid: str, db: DbDep, rds: RedisDep):
     """删除会话（级联删除消息）"""
-    result = delete_session(db, sid)
+    result = await delete_session(db, sid)
     if result.get("deleted") == 1:
+        # 删除会话时一并清掉可能残留的会话锁
         await delete_history(rds, sid)
-        # 删除会话时，也应尝试释放锁，防止残留
-        await release_session_lock(rds, sid)
+        await invalidate_sessions_cache(rds)
     return result
 
 # =========================
 # 健康检查
 # =========================
 @app.get("/health")
-def health():
+async def health():
     return {"ok": True}
 
 # =========================
 # 精选模型 & 语音 TTS 代理
 # =========================
-import os
-import aiohttp
+# 模型相关配置在进程生命周期内不变，导入时解析一次
+MODELS_CURATED = tuple(m.strip() for m in os.getenv("MODELS_CURATED", "deepseek-v3").split(",") if m.strip())
+MODELS_DEFAULT = os.getenv("LLM_MODEL", "deepseek-v3")
+VERIFY_MODELS = os.getenv("VERIFY_MODELS", "0") == "1"
+_MODELS_CURATED_SET = frozenset(MODELS_CURATED)
+
+# /models 结果在进程内缓存的秒数（上游模型清单以小时计变化，没必要每次都去问）
+MODELS_CACHE_TTL = float(os.getenv("MODELS_CACHE_TTL", "60"))
+# 上游失败时，退回白名单的结果只缓存这么久：既挡住故障期间的请求洪峰，又能尽快恢复校验
+MODELS_ERROR_CACHE_TTL = float(os.getenv("MODELS_ERROR_CACHE_TTL", "5"))
+_models_cache: Optional[tuple] = None  # (过期时间, 响应 dict)
+_models_lock: Optional[asyncio.Lock] = None  # 缓存过期时只放一个请求去问上游，其余等它的结果（首次使用时创建）
+
+
+def _models_payload(available) -> Dict:
+    models = [{"id": m, "label": m, "recommended": (m == MODELS_DEFAULT)} for m in MODELS_CURATED if m in available]
+    # 确保默认模型一定在列表里
+    if MODELS_DEFAULT not in available:
+        models.insert(0, {"id": MODELS_DEFAULT, "label": MODELS_DEFAULT, "recommended": True})
+    return {"default": MODELS_DEFAULT, "models": models}
+
+
+# 不校验上游时结果是常量，导入时直接算好
+_MODELS_STATIC = _models_payload(_MODELS_CURATED_SET)
 
 @app.get("/models")
 async def list_models():
@@ -352,48 +620,42 @@ async def list_models():
     返回用于前端展示的“精选模型”列表 + 默认模型。
     - MODELS_CURATED: 逗号分隔的模型ID（只展示这些）
     - VERIFY_MODELS=1: 会调上游 /v1/models 过滤不可用项；否则直接返回白名单
+    - 结果缓存 MODELS_CACHE_TTL 秒；上游失败时的兜底结果只缓存 MODELS_ERROR_CACHE_TTL 秒
     """
-    curated = [m.strip() for m in os.getenv("MODELS_CURATED", "deepseek-v3").split(",") if m.strip()]
-    default_model = os.getenv("LLM_MODEL", "deepseek-v3")
-    verify = os.getenv("VERIFY_MODELS", "0") == "1"
-
-    available = set(curated)
-    if verify:
-        base = os.getenv("QINIU_OPENAI_BASE", "").rstrip("/")
-        key  = os.getenv("QINIU_OPENAI_API_KEY", "")
-        if base:
-            try:
-                async with aiohttp.ClientSession() as sess:
-                    async with sess.get(f"{base}/models",
-                                        headers={"Authorization": f"Bearer {key}"} if key else {}) as resp:
-                        data = await resp.json()
-                        ids = {item["id"] for item in data.get("data", []) if "id" in item}
-                        available = set(curated) & ids
-            except Exception:
-                # 上游异常时，退回本地白名单
-                available = set(curated)
-
-    models = [{"id": m, "label": m, "recommended": (m == default_model)} for m in curated if m in available]
-    # 确保默认模型一定在列表里
-    if default_model not in [x["id"] for x in models]:
-        models.insert(0, {"id": default_model, "label": default_model, "recommended": True})
-
-    return {"default": default_model, "models": models}
+    global _models_cache, _models_lock
+    if not VERIFY_MODELS:
+        return _MODELS_STATIC
+
+    if _models_cache is not None and _models_cache[0] > time.monotonic():
+        return _models_cache[1]
+
+    if _models_lock is None:
+        _models_lock = asyncio.Lock()
+    async with _models_lock:
+        now = time.monotonic()
+        if _models_cache is not None and _models_cache[0] > now:
+            return _models_cache[1]
+        try:
+            available = _MODELS_CURATED_SET & await list_model_ids()
+            ttl = MODELS_CACHE_TTL
+        except Exception:
+            # 上游异常（或未配置 QINIU_OPENAI_BASE）时，退回本地白名单，短暂缓存
+            available = _MODELS_CURATED_SET
+            ttl = MODELS_ERROR_CACHE_TTL
+        result = _models_payload(available)
+        _models_cache = (now + ttl, result)
+    return result
 
 # ---- TTS & VoiceList 代理 ----
-from fastapi import Body  # 已在上面导入过 fastapi，这里仅确保 Body 可用
-import os as _os, aiohttp as _aiohttp, base64
-
-QINIU_BASE = _os.getenv("QINIU_OPENAI_BASE", "https://openai.qiniu.com/v1").rstrip("/")
-QINIU_KEY  = _os.getenv("QINIU_OPENAI_API_KEY", "")
+# 语音接口与大模型共用 get_http_client() 的连接池（Authorization 已在客户端默认头里），
+# 不再每次请求新建会话、重新握手
+QINIU_BASE = os.getenv("QINIU_OPENAI_BASE", "https://openai.qiniu.com/v1").rstrip("/")
 
 @app.get("/voice/list")
 async def voice_list_proxy():
     url = f"{QINIU_BASE}/voice/list"
-    headers = {"Authorization": f"Bearer {QINIU_KEY}"} if QINIU_KEY else {}
-    async with _aiohttp.ClientSession() as s:
-        async with s.get(url, headers=headers) as r:
-            return await r.json()
+    r = await get_http_client().get(url)
+    return jsonutil.loads(r.content)
 
 class TTSIn(BaseModel):
     voice_type: str
@@ -407,10 +669,6 @@ async def tts_proxy(body: TTSIn):
     请求七牛 /voice/tts，返回 { audio: <data:audio/mp3;base64,...> , duration_ms }
     """
     url = f"{QINIU_BASE}/voice/tts"
-    headers = {
-        "Authorization": f"Bearer {QINIU_KEY}",
-        "Content-Type": "application/json"
-    }
     payload = {
         "audio": {
             "voice_type": body.voice_type,
@@ -419,12 +677,10 @@ async def tts_proxy(body: TTSIn):
         },
         "request": { "text": body.text }
     }
-    async with _aiohttp.ClientSession() as s:
-        async with s.post(url, headers=headers, json=payload) as r:
-            data = await r.json()
-            # 七牛返回 data 为 base64 音频，addition.duration 为毫秒
-            b64 = data.get("data", "")
-            dur = (data.get("addition") or {}).get("duration")
-            return { "audio": f"data:audio/{body.encoding};base64,{b64}", "duration_ms": int(dur) if dur else None }
-
-# --- END OF FILE main.py ---
\ No newline at end of file
+    r = await get_http_client().post(url, content=jsonutil.dumps(payload))
+    data = jsonutil.loads(r.content)
+    # 七牛返回 data 为 base64 音频，addition.duration 为毫秒；
+    # 前端直接把 audio 当 <audio src> 用，所以保留 data URL 形态，base64 原样透传、不解码
+    b64 = data.get("data", "")
+    dur = (data.get("addition") or {}).get("duration")
+    return { "audio": f"data:audio/{body.encoding};base64,{b64}", "duration_ms": int(dur) if dur else None }
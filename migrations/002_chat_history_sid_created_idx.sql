@@ -0,0 +1,7 @@
+-- load_history_from_db / list_messages 按 (session_id, created_at) 范围扫描，免排序
+-- CONCURRENTLY 不能放在事务里执行：psql -f 直接运行即可
+CREATE INDEX CONCURRENTLY IF NOT EXISTS chat_history_sid_created_idx
+    ON chat_history (session_id, created_at);
+
+-- 单列 session_id 索引已被上面的复合索引覆盖（前缀列相同）
+DROP INDEX CONCURRENTLY IF EXISTS ix_chat_history_session_id;
@@ -0,0 +1,3 @@
+-- 新消息不再写 chat_history.character_name（角色名经 character_id 关联 character_info 获取）
+-- 必须在部署不写该列的新代码之前执行：列仍为 NOT NULL 时新代码的每次 add_turn 都会失败
+ALTER TABLE chat_history ALTER COLUMN character_name DROP NOT NULL;
@@ -0,0 +1,6 @@
+-- 角色名按 lower(name) 唯一：按名查找 / 创建判重都用 lower(name)，既走索引又防止大小写不同的重名
+-- 已有重名（忽略大小写）会导致建索引失败，先用下面的查询找出并处理：
+--   SELECT lower(name), array_agg(id) FROM character_info GROUP BY 1 HAVING count(*) > 1;
+-- CONCURRENTLY 不能放在事务里执行：psql -f 直接运行即可
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS character_info_lower_name_uidx
+    ON character_info (lower(name));
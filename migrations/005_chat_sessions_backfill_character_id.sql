@@ -0,0 +1,15 @@
+-- 旧会话的角色只记在 chat_history.character_name 上（chat_sessions.character_id 为空）；
+-- list_sessions 以 character_id 关联 character_info 取角色名，这里按名字把 character_id 补上
+-- （名字匹配规则与按名查找一致：忽略首尾空白与大小写）。找不到对应角色的会话保持为空，
+-- 列表仍会回落到消息上的旧 character_name
+UPDATE chat_sessions cs
+   SET character_id = ci.id
+  FROM (
+        SELECT DISTINCT ON (session_id) session_id, character_name
+          FROM chat_history
+         WHERE character_name IS NOT NULL AND character_name <> ''
+      ORDER BY session_id, created_at, id
+       ) h
+  JOIN character_info ci ON lower(ci.name) = lower(btrim(h.character_name))
+ WHERE cs.id = h.session_id
+   AND cs.character_id IS NULL;